@@ -0,0 +1,17 @@
+"""
+Import ftputil -and ftputil.error- once for the whole plugin, falling back
+to the copy bundled with it.
+"""
+
+try:
+    import ftputil
+    import ftputil.error
+except ImportError:
+    import os
+    import sys
+    sys.path.append(
+        os.path.join(os.path.dirname(__file__), 'ftputil-3.4'))
+    import ftputil
+    import ftputil.error
+
+__all__ = ['ftputil']
@@ -1,4 +1,5 @@
-from operator import itemgetter
+from itertools import islice
+from os.path import expanduser
 from urllib.parse import urlparse
 import webbrowser
 
@@ -9,7 +10,42 @@ from fman.clipboard import set_text
 from fman.url import splitscheme
 
 from .filesystems import is_ftp
-from .ftp import FtpWrapper
+from .ftp import FtpWrapper, get_url_without_path
+
+_HOME_URL = 'file://' + expanduser('~')
+# Far more than the quicksearch popup shows at once
+_MAX_QUICKSEARCH_ITEMS = 200
+
+
+def _with_lowercase(items):
+    """Pair every quicksearch candidate with its lowercase form."""
+    return [(item, item.lower()) for item in items]
+
+
+def _substring_matches(items, query):
+    """
+    Yield a `QuicksearchItem` for every `(item, item_lower)` pair of `items`
+    containing `query`, ignoring case, stopping after the first
+    `_MAX_QUICKSEARCH_ITEMS` matches.
+    """
+    # Local alias: avoids a global lookup per yielded item
+    make_item = QuicksearchItem
+    if not query:
+        # Nothing typed yet, every item matches without a highlight
+        for item, _ in islice(items, _MAX_QUICKSEARCH_ITEMS):
+            yield make_item(item)
+        return
+    query = query.lower()
+    query_len = len(query)
+    matches = 0
+    for item, item_lower in items:
+        index = item_lower.find(query)
+        if index == -1:
+            continue
+        yield make_item(item, highlight=range(index, index + query_len))
+        matches += 1
+        if matches == _MAX_QUICKSEARCH_ITEMS:
+            return
 
 
 class OpenFtpLocation(DirectoryPaneCommand):
@@ -24,27 +60,19 @@ class OpenFtpLocation(DirectoryPaneCommand):
 
 class OpenFtpBookmark(DirectoryPaneCommand):
     def __call__(self):
+        bookmarks = \
+            load_json('FTP Bookmarks.json', default={})
+        # Sort once per quicksearch session instead of on every keystroke
+        self._items = _with_lowercase(sorted(bookmarks))
         result = show_quicksearch(self._get_items)
         if result and result[1]:
-            # Fetch bookmarks to connect to the default path
-            bookmarks = \
-                load_json('FTP Bookmarks.json', default={})
+            # Use the bookmark to connect to the default path
             bookmark = bookmarks[result[1]]
             url = urlparse(result[1])._replace(path=bookmark[1]).geturl()
             self.pane.set_path(url)
 
     def _get_items(self, query):
-        bookmarks = \
-            load_json('FTP Bookmarks.json', default={})
-
-        for item in sorted(bookmarks.keys()):
-            try:
-                index = item.lower().index(query)
-            except ValueError:
-                continue
-            else:
-                highlight = range(index, index + len(query))
-                yield QuicksearchItem(item, highlight=highlight)
+        return _substring_matches(self._items, query)
 
 
 class AddFtpBookmark(DirectoryPaneCommand):
@@ -68,16 +96,15 @@ class AddFtpBookmark(DirectoryPaneCommand):
             load_json('FTP Bookmarks.json', default={}, save_on_quit=True)
 
         # XXX URL is split in `(base, path)` to allow setting a default path
-        u = urlparse(url)
-        base = alias = u._replace(path='').geturl()
-        path = u.path
+        base = alias = get_url_without_path(url)
+        path = url[len(base):]
 
         if base in bookmarks:
             # XXX if base URL points to an alias, resolve to an existing URL
             base = bookmarks[base][0]
 
         if path and path.strip('/'):
-            alias += '-'.join(path.split('/'))
+            alias += path.replace('/', '-')
         alias, ok = show_prompt(
             'Please enter an alias (will override aliases with the same name)',
             default=alias)
@@ -88,7 +115,9 @@ class AddFtpBookmark(DirectoryPaneCommand):
             # XXX alias must include the FTP scheme
             scheme, _ = splitscheme(base)
             alias = scheme + alias
-        if urlparse(alias).path:
+        # XXX anything after the host part is a path
+        _, alias_location = splitscheme(alias)
+        if '/' in alias_location:
             show_alert('Aliases should not include path information')
             return
 
@@ -97,51 +126,37 @@ class AddFtpBookmark(DirectoryPaneCommand):
 
 class RemoveFtpBookmark(DirectoryPaneCommand):
     def __call__(self):
+        bookmarks = \
+            load_json('FTP Bookmarks.json', default={}, save_on_quit=True)
+        # Sort once per quicksearch session instead of on every keystroke
+        self._items = _with_lowercase(sorted(bookmarks))
         result = show_quicksearch(self._get_items)
         if result and result[1]:
             choice = show_alert(
-                'Are you sure you want to delete "%s"' % (result[1],),
+                f'Are you sure you want to delete "{result[1]}"',
                 buttons=YES | NO,
                 default_button=NO
             )
             if choice == YES:
-                bookmarks = \
-                    load_json('FTP Bookmarks.json', default={}, save_on_quit=True)
                 bookmarks.pop(result[1], None)
 
     def _get_items(self, query):
-        bookmarks = \
-            load_json('FTP Bookmarks.json', default={})
-
-        for item in sorted(bookmarks.keys()):
-            try:
-                index = item.lower().index(query)
-            except ValueError:
-                continue
-            else:
-                highlight = range(index, index + len(query))
-                yield QuicksearchItem(item, highlight=highlight)
+        return _substring_matches(self._items, query)
 
 
 class OpenFtpHistory(DirectoryPaneCommand):
     def __call__(self):
+        history = \
+            load_json('FTP History.json', default={})
+        # Sort once per quicksearch session instead of on every keystroke
+        self._items = _with_lowercase(
+            sorted(history, key=history.get, reverse=True))
         result = show_quicksearch(self._get_items)
         if result and result[1]:
             self.pane.set_path(result[1])
 
     def _get_items(self, query):
-        bookmarks = \
-            load_json('FTP History.json', default={})
-
-        for item, _ in sorted(
-                bookmarks.items(), key=itemgetter(1), reverse=True):
-            try:
-                index = item.lower().index(query)
-            except ValueError:
-                continue
-            else:
-                highlight = range(index, index + len(query))
-                yield QuicksearchItem(item, highlight=highlight)
+        return _substring_matches(self._items, query)
 
 
 class NavigateToOpenFtpConnection(DirectoryPaneCommand):
@@ -151,10 +166,12 @@ class NavigateToOpenFtpConnection(DirectoryPaneCommand):
             show_alert('No open FTP connections.\n\n'
                       'Connect to an FTP server first using a bookmark or URL.')
             return
+        # Snapshot the connections once for the whole quicksearch session
+        self._items = \
+            _with_lowercase(base_url for base_url, _ in connections)
         result = show_quicksearch(self._get_items)
         if result and result[1]:
             # Look up the last visited path for the selected base URL
-            connections = FtpWrapper.get_open_connections()
             for base_url, last_url in connections:
                 if base_url == result[1]:
                     self.pane.set_path(last_url)
@@ -163,15 +180,7 @@ class NavigateToOpenFtpConnection(DirectoryPaneCommand):
             self.pane.set_path(result[1] + '/')
 
     def _get_items(self, query):
-        connections = FtpWrapper.get_open_connections()
-        for base_url, _ in connections:
-            try:
-                index = base_url.lower().index(query)
-            except ValueError:
-                continue
-            else:
-                highlight = range(index, index + len(query))
-                yield QuicksearchItem(base_url, highlight=highlight)
+        return _substring_matches(self._items, query)
 
 
 class CloseIndividualFtpConnection(DirectoryPaneCommand):
@@ -181,6 +190,9 @@ class CloseIndividualFtpConnection(DirectoryPaneCommand):
             show_alert('No open FTP connections.\n\n'
                       'There are no active connections to close.')
             return
+        # Snapshot the connections once for the whole quicksearch session
+        self._items = \
+            _with_lowercase(base_url for base_url, _ in connections)
         result = show_quicksearch(self._get_items)
         if result and result[1]:
             base_url = result[1]
@@ -188,21 +200,13 @@ class CloseIndividualFtpConnection(DirectoryPaneCommand):
             FtpWrapper.close_connection_by_url(base_url)
             # If currently viewing that FTP, navigate to home
             current_url = self.pane.get_path()
-            if is_ftp(current_url) and base_url in current_url:
-                from os.path import expanduser
-                self.pane.set_path('file://' + expanduser('~'))
+            if is_ftp(current_url) and \
+                    FtpWrapper.get_base_url(current_url) == base_url:
+                self.pane.set_path(_HOME_URL)
             show_alert('FTP connection closed:\n\n' + base_url)
 
     def _get_items(self, query):
-        connections = FtpWrapper.get_open_connections()
-        for base_url, _ in connections:
-            try:
-                index = base_url.lower().index(query)
-            except ValueError:
-                continue
-            else:
-                highlight = range(index, index + len(query))
-                yield QuicksearchItem(base_url, highlight=highlight)
+        return _substring_matches(self._items, query)
 
 
 class RemoveFtpHistory(DirectoryPaneCommand):
@@ -243,97 +247,107 @@ class CloseFtpConnections(DirectoryPaneCommand):
         # Navigate to home directory if currently viewing FTP
         current_url = self.pane.get_path()
         if is_ftp(current_url):
-            from os.path import expanduser
-            self.pane.set_path('file://' + expanduser('~'))
+            self.pane.set_path(_HOME_URL)
 
         show_alert('All FTP connections have been closed.\n\n'
                   'You have been disconnected from the FTP server.')
 
 
-def _get_ftp_bookmark_info(ftp_url):
+def _get_ftp_bookmark_info(ftp_url, save=False):
     """
     Helper function to get bookmark information for an FTP URL.
-    Returns: (url_without_path, bookmark, bookmarks_dict, parsed_url) or (None, None, None, None) if invalid
+    Bookmarks are only scheduled to be saved on quit if `save` is set.
+    Returns: (url_without_path, bookmark, bookmarks_dict, ftp_path) or None if invalid
     """
     # Check if we're on an FTP path
     if not is_ftp(ftp_url):
         show_alert('This command only works on FTP paths')
-        return None, None, None, None
+        return None
 
-    # Parse the FTP URL
-    u = urlparse(ftp_url)
-    url_without_path = u._replace(path='').geturl()
+    # Split the FTP URL
+    url_without_path = get_url_without_path(ftp_url)
+    ftp_path = ftp_url[len(url_without_path):]
 
     # Load bookmarks
-    bookmarks = load_json('FTP Bookmarks.json', default={}, save_on_quit=True)
+    bookmarks = \
+        load_json('FTP Bookmarks.json', default={}, save_on_quit=save)
 
     if url_without_path not in bookmarks:
         show_alert(
             'No bookmark found for this FTP server.\n\n'
             'Please add a bookmark first using "Add Ftp Bookmark".'
         )
-        return None, None, None, None
+        return None
 
-    bookmark = bookmarks[url_without_path]
-    return url_without_path, bookmark, bookmarks, u
+    # Bookmark structure: [ftp_url, default_path, web_url], older bookmarks
+    # may lack the trailing fields
+    bookmark = tuple(bookmarks[url_without_path])
+    bookmark += ('',) * (3 - len(bookmark))
+    return url_without_path, bookmark, bookmarks, ftp_path
 
 
-class CopyFtpWebUrl(DirectoryPaneCommand):
-    """Copy web URL for FTP file to clipboard"""
+def _is_on_ftp_path(pane):
+    """Only show FTP-specific commands in the command palette on FTP paths."""
+    return is_ftp(pane.get_path())
 
-    def __call__(self):
-        # Get current path or selected file
-        selected = self.pane.get_selected_files()
-        if selected:
-            ftp_url = selected[0]
-        else:
-            ftp_url = self.pane.get_path()
 
-        # Get bookmark info
-        url_without_path, bookmark, bookmarks, u = _get_ftp_bookmark_info(ftp_url)
-        if not bookmark:
-            return
+def _resolve_web_url(pane):
+    """
+    Helper function to build the web URL for the selected file -or the
+    current path- of an FTP pane, prompting for the bookmark's base web URL
+    if it has not been configured yet.
+    Returns: web_url or None if invalid or cancelled
+    """
+    # Get current path or selected file
+    selected = pane.get_selected_files()
+    if selected:
+        ftp_url = selected[0]
+    else:
+        ftp_url = pane.get_path()
+
+    # Get bookmark info
+    info = _get_ftp_bookmark_info(ftp_url)
+    if info is None:
+        return None
+    url_without_path, bookmark, _, ftp_path = info
+
+    # Check if base_url is configured (index 2 in bookmark array)
+    base_web_url = bookmark[2]
+
+    # If not configured, prompt user for it
+    if not base_web_url:
+        base_web_url, ok = show_prompt(
+            'Enter the base web URL for this FTP server\n'
+            '(e.g., https://example.com)',
+            default='https://'
+        )
 
-        # Check if base_url is configured (index 2 in bookmark array)
-        base_web_url = None
-        if len(bookmark) >= 3 and bookmark[2]:
-            base_web_url = bookmark[2]
-
-        # If not configured, prompt user for it
-        if not base_web_url:
-            # Get current web URL for prefill, or use default
-            current_web_url = ''
-            if len(bookmark) >= 3 and bookmark[2]:
-                current_web_url = bookmark[2]
-
-            base_web_url, ok = show_prompt(
-                'Enter the base web URL for this FTP server\n'
-                '(e.g., https://example.com)',
-                default=current_web_url if current_web_url else 'https://'
-            )
+        if not (base_web_url and ok):
+            return None
+
+        # Save the web URL to bookmark (preserve existing values)
+        bookmarks = \
+            load_json('FTP Bookmarks.json', default={}, save_on_quit=True)
+        bookmarks[url_without_path] = (bookmark[0], bookmark[1], base_web_url)
 
-            if not (base_web_url and ok):
-                return
+    # Construct web URL
+    return base_web_url.rstrip('/') + ftp_path
 
-            # Save the web URL to bookmark (preserve existing values)
-            # Bookmark structure: [ftp_url, default_path, web_url]
-            if len(bookmark) >= 2:
-                bookmarks[url_without_path] = (bookmark[0], bookmark[1], base_web_url)
-            else:
-                bookmarks[url_without_path] = (bookmark[0], '', base_web_url)
 
-        ftp_path = u.path
+class CopyFtpWebUrl(DirectoryPaneCommand):
+    """Copy web URL for FTP file to clipboard"""
 
-        # Construct web URL
-        web_url = base_web_url.rstrip('/') + ftp_path
+    def __call__(self):
+        web_url = _resolve_web_url(self.pane)
+        if web_url is None:
+            return
 
         # Copy to clipboard
         set_text(web_url)
         show_status_message(f'Copied to clipboard: {web_url}')
 
     def is_visible(self):
-        # Only show in command palette when on FTP path
-        return is_ftp(self.pane.get_path())
+        return _is_on_ftp_path(self.pane)
 
 
 class ChangeFtpWebUrl(DirectoryPaneCommand):
@@ -344,32 +358,24 @@ class ChangeFtpWebUrl(DirectoryPaneCommand):
         ftp_url = self.pane.get_path()
 
         # Get bookmark info
-        url_without_path, bookmark, bookmarks, u = _get_ftp_bookmark_info(ftp_url)
-        if not bookmark:
+        info = _get_ftp_bookmark_info(ftp_url, save=True)
+        if info is None:
             return
-
-        # Get current web URL if set
-        current_web_url = ''
-        if len(bookmark) >= 3 and bookmark[2]:
-            current_web_url = bookmark[2]
+        url_without_path, bookmark, bookmarks, _ = info
 
         # Prompt user for new web URL
         new_web_url, ok = show_prompt(
             'Enter the new base web URL for this FTP server\n'
             '(e.g., https://example.com)\n'
             'Leave empty to remove the web URL',
-            default=current_web_url
+            default=bookmark[2]
         )
 
         if not ok:
             return
 
         # Update the bookmark with new web URL
-        # Bookmark structure: [ftp_url, default_path, web_url]
-        if len(bookmark) >= 2:
-            bookmarks[url_without_path] = (bookmark[0], bookmark[1], new_web_url)
-        else:
-            bookmarks[url_without_path] = (bookmark[0], '', new_web_url)
+        bookmarks[url_without_path] = (bookmark[0], bookmark[1], new_web_url)
 
         if new_web_url:
             show_alert(f'Web URL updated to:\n{new_web_url}')
@@ -377,59 +383,17 @@ class ChangeFtpWebUrl(DirectoryPaneCommand):
             show_alert('Web URL has been removed')
 
     def is_visible(self):
-        # Only show in command palette when on FTP path
-        return is_ftp(self.pane.get_path())
+        return _is_on_ftp_path(self.pane)
 
 
 class OpenFtpWebUrl(DirectoryPaneCommand):
     """Open web URL for FTP file in default browser"""
 
     def __call__(self):
-        # Get current path or selected file
-        selected = self.pane.get_selected_files()
-        if selected:
-            ftp_url = selected[0]
-        else:
-            ftp_url = self.pane.get_path()
-
-        # Get bookmark info
-        url_without_path, bookmark, bookmarks, u = _get_ftp_bookmark_info(ftp_url)
-        if not bookmark:
+        web_url = _resolve_web_url(self.pane)
+        if web_url is None:
             return
 
-        # Check if base_url is configured (index 2 in bookmark array)
-        base_web_url = None
-        if len(bookmark) >= 3 and bookmark[2]:
-            base_web_url = bookmark[2]
-
-        # If not configured, prompt user for it
-        if not base_web_url:
-            # Get current web URL for prefill, or use default
-            current_web_url = ''
-            if len(bookmark) >= 3 and bookmark[2]:
-                current_web_url = bookmark[2]
-
-            base_web_url, ok = show_prompt(
-                'Enter the base web URL for this FTP server\n'
-                '(e.g., https://example.com)',
-                default=current_web_url if current_web_url else 'https://'
-            )
-
-            if not (base_web_url and ok):
-                return
-
-            # Save the web URL to bookmark (preserve existing values)
-            # Bookmark structure: [ftp_url, default_path, web_url]
-            if len(bookmark) >= 2:
-                bookmarks[url_without_path] = (bookmark[0], bookmark[1], base_web_url)
-            else:
-                bookmarks[url_without_path] = (bookmark[0], '', base_web_url)
-
-        ftp_path = u.path
-
-        # Construct web URL
-        web_url = base_web_url.rstrip('/') + ftp_path
-
         # Open in default browser
         try:
             webbrowser.open(web_url)
@@ -438,5 +402,4 @@ class OpenFtpWebUrl(DirectoryPaneCommand):
             show_alert(f'Failed to open browser: {str(e)}')
 
     def is_visible(self):
-        # Only show in command palette when on FTP path
-        return is_ftp(self.pane.get_path())
+        return _is_on_ftp_path(self.pane)
@@ -1,30 +1,43 @@
 import errno
-import re
 import stat
 from datetime import datetime
 from io import UnsupportedOperation
-from os.path import commonprefix, dirname, join as pathjoin
-from tempfile import NamedTemporaryFile
+from posixpath import join as pathjoin
+from urllib.parse import urlparse
 
 import os
 
 from fman import fs, load_json, show_status_message, Task, submit_task
 from fman.fs import FileSystem, cached
-from fman.url import join as urljoin, splitscheme
+from fman.url import splitscheme
 
-from .ftp import FtpWrapper
+from ._ftputil_import import ftputil
+from .ftp import FtpWrapper, is_connection_error
 
-try:
-    import ftputil.error
-except ImportError:
-    import os
-    import sys
-    sys.path.append(
-        os.path.join(os.path.dirname(__file__), 'ftputil-3.4'))
-    import ftputil.error
+_FTP_PREFIXES = ('ftp://', 'ftps://')
 
-is_ftp = re.compile('^ftps?://').match
-is_file = re.compile('^file://').match
+# Column attribute → (its value from a stat result, whether it follows
+# symlinks like getsize() and getmtime() do)
+_STAT_ATTRIBUTES = {
+    'size_bytes': (lambda st: st.st_size, True),
+    'modified_datetime':
+        (lambda st: datetime.utcfromtimestamp(st.st_mtime), True),
+    'get_permissions': (lambda st: stat.filemode(st.st_mode), False),
+    'get_owner': (lambda st: st.st_uid, False),
+    'get_group': (lambda st: st.st_gid, False),
+}
+
+
+def is_ftp(url):
+    return url.startswith(_FTP_PREFIXES)
+
+
+def is_file(url):
+    return url.startswith('file://')
+
+
+def _with_trailing_slash(url):
+    return url if url.endswith('/') else url + '/'
 
 
 class FtpFs(FileSystem):
@@ -44,36 +57,36 @@ class FtpFs(FileSystem):
                 'ftpclient.columns.Permissions', 'ftpclient.columns.Owner',
                 'ftpclient.columns.Group')
 
+    # A cache miss on any of the following loads (and caches) all of them
+    # with a single lstat() call. Symlinks take their size and modification
+    # time from their targets
+
     @cached
     def size_bytes(self, path):
-        with FtpWrapper(self.scheme + path) as ftp:
-            return ftp.conn.path.getsize(ftp.path)
+        return self._load_stat(path, 'size_bytes')
 
     @cached
     def modified_datetime(self, path):
-        with FtpWrapper(self.scheme + path) as ftp:
-            return datetime.utcfromtimestamp(ftp.conn.path.getmtime(ftp.path))
+        return self._load_stat(path, 'modified_datetime')
 
     @cached
     def get_permissions(self, path):
-        with FtpWrapper(self.scheme + path) as ftp:
-            return stat.filemode(ftp.conn.lstat(ftp.path).st_mode)
+        return self._load_stat(path, 'get_permissions')
 
     @cached
     def get_owner(self, path):
-        with FtpWrapper(self.scheme + path) as ftp:
-            return ftp.conn.lstat(ftp.path).st_uid
+        return self._load_stat(path, 'get_owner')
 
     @cached
     def get_group(self, path):
-        with FtpWrapper(self.scheme + path) as ftp:
-            return ftp.conn.lstat(ftp.path).st_gid
+        return self._load_stat(path, 'get_group')
 
     @cached
     def exists(self, path):
         try:
-            with FtpWrapper(self.scheme + path) as ftp:
-                return ftp.conn.path.exists(ftp.path)
+            return self._with_retry(
+                self.scheme + path,
+                lambda ftp: ftp.conn.path.exists(ftp.path))
         except (OSError, IOError, ConnectionError, ftputil.error.FTPError):
             # If we can't connect, the path doesn't exist from our perspective
             return False
@@ -81,8 +94,9 @@ class FtpFs(FileSystem):
     @cached
     def is_dir(self, path):
         try:
-            with FtpWrapper(self.scheme + path) as ftp:
-                return ftp.conn.path.isdir(ftp.path)
+            return self._with_retry(
+                self.scheme + path,
+                lambda ftp: ftp.conn.path.isdir(ftp.path))
         except (OSError, IOError, ConnectionError, ftputil.error.FTPError):
             # If we can't connect, assume it's not a directory
             return False
@@ -92,35 +106,69 @@ class FtpFs(FileSystem):
         if not path:
             return
         show_status_message('Loading %s...' % (path,))
-        with FtpWrapper(self.scheme + path) as ftp:
-            # ftputil's listdir() automatically populates its internal
-            # _lstat_cache with all file stats. No need to manually
-            # pre-fetch stats - they're already cached!
-            for name in ftp.conn.listdir(ftp.path):
-                yield name
+
+        settings = load_json('FTP Settings.json', default={})
+        # Only filenames are shown in fast mode, don't bother with stats
+        prefill_stats = not settings.get('disable_detailed_stats', False)
+
+        def list_dir(ftp):
+            names = ftp.conn.listdir(ftp.path)
+            if prefill_stats:
+                self._prefill_stats(ftp, path, names)
+            return names
+
+        names = self._with_retry(self.scheme + path, list_dir)
         show_status_message('Ready.', timeout_secs=0)
+        yield from names
+
+    def _prefill_stats(self, ftp, path, names):
+        # ftputil's listdir() populates its internal _lstat_cache from
+        # the same LIST response, so these lstat() calls don't hit the
+        # server. Copying the stats to fman's cache saves the columns
+        # one FtpWrapper round per file and attribute.
+        # listdir() grows the stat cache to fit the whole listing, so none
+        # of its entries are evicted yet
+        lstat, cache_stats = ftp.conn.lstat, self._cache_stats
+        # Equivalent to pathjoin() for every name, without re-checking
+        # the directory's trailing slash each time
+        remote_dir = pathjoin(ftp.path, '')
+        local_dir = pathjoin(path, '')
+        for name in names:
+            try:
+                cache_stats(local_dir + name, lstat(remote_dir + name))
+            except (OSError, ValueError, OverflowError,
+                    ftputil.error.FTPError) as e:
+                # Best effort: the columns load this entry's stats -or
+                # report its error- themselves
+                if is_connection_error(e):
+                    raise
 
     def delete(self, path):
-        with FtpWrapper(self.scheme + path) as ftp:
+        def delete(ftp):
             if self.is_dir(path):
                 ftp.conn.rmtree(ftp.path)
             else:
                 ftp.conn.remove(ftp.path)
 
+        self._with_retry(self.scheme + path, delete)
+
     def move_to_trash(self, path):
         # ENOSYS: Function not implemented
         raise OSError(errno.ENOSYS, "FTP has no Trash support")
 
     def mkdir(self, path):
-        with FtpWrapper(self.scheme + path) as ftp:
-            ftp.conn.makedirs(ftp.path)
+        self._with_retry(
+            self.scheme + path, lambda ftp: ftp.conn.makedirs(ftp.path))
 
     def touch(self, path):
         if self.exists(path):
             raise OSError(errno.EEXIST, "File exists")
-        with FtpWrapper(self.scheme + path) as ftp:
-            with NamedTemporaryFile(delete=True) as tmp:
-                ftp.conn.upload(tmp.name, ftp.path)
+        def touch(ftp):
+            # Storing an empty stream needs no local file to upload
+            with ftp.conn.open(ftp.path, 'wb'):
+                pass
+
+        self._with_retry(self.scheme + path, touch)
 
     def samefile(self, path1, path2):
         return path1 == path2
@@ -129,44 +177,49 @@ class FtpFs(FileSystem):
         # Recursive copy
         if fs.is_dir(src_url):
             fs.mkdir(dst_url)
+            # Same as fman.url.join() for the names iterdir() returns, without
+            # re-parsing both URLs for each of them
+            src_prefix = _with_trailing_slash(src_url)
+            dst_prefix = _with_trailing_slash(dst_url)
             for fname in fs.iterdir(src_url):
-                fs.copy(urljoin(src_url, fname), urljoin(dst_url, fname))
+                fs.copy(src_prefix + fname, dst_prefix + fname)
             return
 
         if is_ftp(src_url) and is_ftp(dst_url):
             # FTP to FTP copy
-            src_ftp_wrapper = FtpWrapper(src_url)
-            dst_ftp_wrapper = FtpWrapper(dst_url)
-            filename = src_ftp_wrapper.path.split('/')[-1]
+            filename = urlparse(src_url).path.rsplit('/', 1)[-1]
 
             class FtpToFtpCopyTask(Task):
                 def __init__(task_self):
                     super().__init__(f'Copying {filename}...')
 
                 def __call__(task_self):
-                    with src_ftp_wrapper as src_ftp, dst_ftp_wrapper as dst_ftp:
-                        # Get file size for progress
-                        try:
-                            file_size = src_ftp.conn.path.getsize(src_ftp.path)
-                        except:
-                            file_size = 0
-
+                    self._with_retry(src_url, lambda src_ftp: self._with_retry(
+                        dst_url, lambda dst_ftp: task_self._copy(src_ftp, dst_ftp)))
+
+                def _copy(task_self, src_ftp, dst_ftp):
+                    # Get file size for progress
+                    try:
+                        file_size = src_ftp.conn.path.getsize(src_ftp.path)
+                    except:
+                        file_size = 0
+
+                    if file_size:
+                        task_self.set_size(file_size)
+
+                    transferred = [0]
+                    def progress_callback(chunk):
+                        task_self.check_canceled()
+                        transferred[0] += len(chunk)
                         if file_size:
-                            task_self.set_size(file_size)
-
-                        transferred = [0]
-                        def progress_callback(chunk):
-                            task_self.check_canceled()
-                            transferred[0] += len(chunk)
-                            if file_size:
-                                task_self.set_progress(transferred[0])
-                                percent = int((transferred[0] / file_size) * 100)
-                                show_status_message(f'Copying... {percent}% ({transferred[0] // 1024} KB / {file_size // 1024} KB)')
-
-                        with src_ftp.conn.open(src_ftp.path, 'rb') as src, \
-                                dst_ftp.conn.open(dst_ftp.path, 'wb') as dst:
-                            dst_ftp.conn.copyfileobj(src, dst, callback=progress_callback)
-                        show_status_message('Ready.', timeout_secs=0)
+                            task_self.set_progress(transferred[0])
+                            percent = int((transferred[0] / file_size) * 100)
+                            show_status_message(f'Copying... {percent}% ({transferred[0] // 1024} KB / {file_size // 1024} KB)')
+
+                    with src_ftp.conn.open(src_ftp.path, 'rb') as src, \
+                            dst_ftp.conn.open(dst_ftp.path, 'wb') as dst:
+                        dst_ftp.conn.copyfileobj(src, dst, callback=progress_callback)
+                    show_status_message('Ready.', timeout_secs=0)
 
             task = FtpToFtpCopyTask()
             submit_task(task)
@@ -174,35 +227,36 @@ class FtpFs(FileSystem):
         elif is_ftp(src_url) and is_file(dst_url):
             # FTP download
             _, dst_path = splitscheme(dst_url)
-            ftp_wrapper = FtpWrapper(src_url)
-            filename = ftp_wrapper.path.split('/')[-1]
+            filename = urlparse(src_url).path.rsplit('/', 1)[-1]
 
             class FtpDownloadTask(Task):
                 def __init__(task_self):
                     super().__init__(f'Downloading {filename}...')
 
                 def __call__(task_self):
-                    with ftp_wrapper as ftp:
-                        # Get file size for progress
-                        try:
-                            file_size = ftp.conn.path.getsize(ftp.path)
-                        except:
-                            file_size = 0
-
+                    self._with_retry(src_url, task_self._download)
+
+                def _download(task_self, ftp):
+                    # Get file size for progress
+                    try:
+                        file_size = ftp.conn.path.getsize(ftp.path)
+                    except:
+                        file_size = 0
+
+                    if file_size:
+                        task_self.set_size(file_size)
+
+                    transferred = [0]
+                    def progress_callback(chunk):
+                        task_self.check_canceled()
+                        transferred[0] += len(chunk)
                         if file_size:
-                            task_self.set_size(file_size)
-
-                        transferred = [0]
-                        def progress_callback(chunk):
-                            task_self.check_canceled()
-                            transferred[0] += len(chunk)
-                            if file_size:
-                                task_self.set_progress(transferred[0])
-                                percent = int((transferred[0] / file_size) * 100)
-                                show_status_message(f'Downloading... {percent}% ({transferred[0] // 1024} KB / {file_size // 1024} KB)')
+                            task_self.set_progress(transferred[0])
+                            percent = int((transferred[0] / file_size) * 100)
+                            show_status_message(f'Downloading... {percent}% ({transferred[0] // 1024} KB / {file_size // 1024} KB)')
 
-                        ftp.conn.download(ftp.path, dst_path, callback=progress_callback)
-                        show_status_message('Ready.', timeout_secs=0)
+                    ftp.conn.download(ftp.path, dst_path, callback=progress_callback)
+                    show_status_message('Ready.', timeout_secs=0)
 
             task = FtpDownloadTask()
             submit_task(task)
@@ -210,7 +264,6 @@ class FtpFs(FileSystem):
         elif is_file(src_url) and is_ftp(dst_url):
             # FTP upload
             _, src_path = splitscheme(src_url)
-            ftp_wrapper = FtpWrapper(dst_url)
             filename = os.path.basename(src_path)
 
             class FtpUploadTask(Task):
@@ -218,27 +271,29 @@ class FtpFs(FileSystem):
                     super().__init__(f'Uploading {filename}...')
 
                 def __call__(task_self):
-                    with ftp_wrapper as ftp:
-                        # Get local file size for progress
-                        try:
-                            file_size = os.path.getsize(src_path)
-                        except:
-                            file_size = 0
-
+                    self._with_retry(dst_url, task_self._upload)
+
+                def _upload(task_self, ftp):
+                    # Get local file size for progress
+                    try:
+                        file_size = os.path.getsize(src_path)
+                    except:
+                        file_size = 0
+
+                    if file_size:
+                        task_self.set_size(file_size)
+
+                    transferred = [0]
+                    def progress_callback(chunk):
+                        task_self.check_canceled()
+                        transferred[0] += len(chunk)
                         if file_size:
-                            task_self.set_size(file_size)
+                            task_self.set_progress(transferred[0])
+                            percent = int((transferred[0] / file_size) * 100)
+                            show_status_message(f'Uploading... {percent}% ({transferred[0] // 1024} KB / {file_size // 1024} KB)')
 
-                        transferred = [0]
-                        def progress_callback(chunk):
-                            task_self.check_canceled()
-                            transferred[0] += len(chunk)
-                            if file_size:
-                                task_self.set_progress(transferred[0])
-                                percent = int((transferred[0] / file_size) * 100)
-                                show_status_message(f'Uploading... {percent}% ({transferred[0] // 1024} KB / {file_size // 1024} KB)')
-
-                        ftp.conn.upload(src_path, ftp.path, callback=progress_callback)
-                        show_status_message('Ready.', timeout_secs=0)
+                    ftp.conn.upload(src_path, ftp.path, callback=progress_callback)
+                    show_status_message('Ready.', timeout_secs=0)
 
             task = FtpUploadTask()
             submit_task(task)
@@ -247,14 +302,13 @@ class FtpFs(FileSystem):
 
     def move(self, src_url, dst_url):
         # Rename on same server
-        src_scheme, src_path = splitscheme(src_url)
-        dst_scheme, dst_path = splitscheme(dst_url)
-        if src_scheme == dst_scheme and commonprefix([src_path, dst_path]):
+        src, dst = urlparse(src_url), urlparse(dst_url)
+        if (src.scheme, src.netloc) == (dst.scheme, dst.netloc):
             # Use single connection for same-server renames
-            with FtpWrapper(src_url) as ftp:
-                # Get destination path from dst_url
-                dst_ftp = FtpWrapper(dst_url)
-                ftp.conn.rename(ftp.path, dst_ftp.path)
+            # Bookmarks only resolve the server, `FtpWrapper` keeps the path
+            dst_path = dst.path or '/'
+            self._with_retry(
+                src_url, lambda ftp: ftp.conn.rename(ftp.path, dst_path))
             return
 
         fs.copy(src_url, dst_url)
@@ -262,15 +316,67 @@ class FtpFs(FileSystem):
             fs.delete(src_url)
 
     def get_stats(self, path):
-        with FtpWrapper(self.scheme + path) as ftp:
-            lstat = ftp.conn.lstat(ftp.path)
-            dt_mtime = datetime.utcfromtimestamp(lstat.st_mtime)
-            st_mode = stat.filemode(lstat.st_mode)
-            self.cache.put(path, 'size_bytes', lstat.st_size)
-            self.cache.put(path, 'modified_datetime', dt_mtime)
-            self.cache.put(path, 'get_permissions', st_mode)
-            self.cache.put(path, 'get_owner', lstat.st_uid)
-            self.cache.put(path, 'get_group', lstat.st_gid)
+        self._load_stats(path)
+
+    def _load_stats(self, path):
+        return self._with_retry(
+            self.scheme + path,
+            lambda ftp: self._cache_stats(path, ftp.conn.lstat(ftp.path)))
+
+    def _load_stat(self, path, attr):
+        stats = self._load_stats(path)
+        if attr in stats:
+            return stats[attr]
+        # A symlink's size or modification time, or a value that couldn't
+        # be converted: load it on its own, which also reports its error
+        value_of, follow_symlinks = _STAT_ATTRIBUTES[attr]
+        def load(ftp):
+            conn = ftp.conn
+            stat_result = \
+                conn.stat(ftp.path) if follow_symlinks else conn.lstat(ftp.path)
+            return value_of(stat_result)
+
+        return self._with_retry(self.scheme + path, load)
+
+    def _cache_stats(self, path, lstat):
+        mode = lstat.st_mode
+        is_link = stat.S_ISLNK(mode)
+        stats = {}
+        # fman's cache has no multi-attribute put, and its lock is private
+        put = self.cache.put
+        for attr, (value_of, follow_symlinks) in _STAT_ATTRIBUTES.items():
+            if is_link and follow_symlinks:
+                continue
+            try:
+                value = value_of(lstat)
+            except (ValueError, OverflowError, OSError):
+                # e.g. a pre-1970 modification time on Windows: only this
+                # column is affected, see `_load_stat`
+                continue
+            stats[attr] = value
+            put(path, attr, value)
+        # Also answers `exists` and -unless it's a symlink, which `is_dir`
+        # follows- `is_dir`, e.g. for the entries of a listed directory
+        put(path, 'exists', True)
+        if not is_link:
+            put(path, 'is_dir', stat.S_ISDIR(mode))
+        return stats
+
+    def _with_retry(self, url, func):
+        """
+        Return `func(ftp)` run on a pooled connection to `url`.
+        Pooled connections are reused without probing them first, so if the
+        server dropped this one meanwhile, retry once on a new connection.
+        """
+        ftp_wrapper = FtpWrapper(url)
+        try:
+            with ftp_wrapper as ftp:
+                return func(ftp)
+        except Exception as e:
+            if not (ftp_wrapper.reused and is_connection_error(e)):
+                raise
+        with ftp_wrapper as ftp:
+            return func(ftp)
 
 
 class FtpsFs(FtpFs):
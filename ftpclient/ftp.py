@@ -1,18 +1,76 @@
 import ftplib
+import socket
 import threading
 import time
+from collections import OrderedDict, deque
+from functools import lru_cache
 from urllib.parse import unquote, urlparse
 
 from fman import load_json
 
-try:
-    import ftputil
-except ImportError:
-    import os
-    import sys
-    sys.path.append(
-        os.path.join(os.path.dirname(__file__), 'ftputil-3.4'))
-    import ftputil
+from ._ftputil_import import ftputil
+
+
+def is_connection_error(exc):
+    """
+    Whether `exc` means the server closed -or timed out- the connection,
+    rather than failing a particular command.
+    """
+    if isinstance(exc, ftputil.error.FTPError):
+        # ftputil wraps the `ftplib` or socket error it got, if any: errors
+        # it raises by itself (e.g. "directory not empty") are about the
+        # command, even though they have no reply code
+        if exc.__context__ is None:
+            return False
+        return is_connection_error(exc.__context__)
+    if isinstance(exc, ftplib.error_temp):
+        # 421 Service not available, closing control connection
+        return str(exc).startswith('421')
+    return isinstance(
+        exc, (EOFError, ConnectionError, TimeoutError, socket.timeout))
+
+
+def get_url_without_path(url):
+    """
+    Return `url` up to -but not including- the path after its host, i.e.
+    the key of its bookmark.
+    """
+    path_start = url.find('/', url.find('://') + 3)
+    return url if path_start == -1 else url[:path_start]
+
+
+# URLs are parsed for every `FtpWrapper`, i.e. for every file system
+# operation, but the same few are used over and over
+@lru_cache(maxsize=1024)
+def _parse_connection_details(url, bookmark_url):
+    """
+    Return (url, scheme, path, host, port, user, password, hash, base_url)
+    for `url`, connecting to the server of `bookmark_url` instead if given.
+    """
+    u = urlparse(url)
+    if bookmark_url is not None:
+        # Keep the same path
+        u = urlparse(bookmark_url)._replace(path=u.path)
+    scheme = '%s://' % (u.scheme,)
+    host = u.hostname or ''
+    port = u.port or 21
+    user = unquote(u.username or '')
+    passwd = unquote(u.password or '')
+    # The base URL (without path), e.g. "ftp://user@host:21"
+    if user:
+        base_url = '%s%s@%s:%d' % (scheme, user, host, port)
+    else:
+        base_url = '%s%s:%d' % (scheme, host, port)
+    # Plain and TLS connections to the same server must not be pooled
+    # together
+    return (
+        u.geturl(), scheme, u.path or '/', host, port, user, passwd,
+        hash((scheme, host, port, user, passwd)), base_url)
+
+
+# Increase stat cache size for large directories, for every FTPHost
+# Default is 5000, which causes cache eviction in large dirs
+ftputil.stat_cache.StatCache._DEFAULT_CACHE_SIZE = 20000
 
 
 class FtpSession(ftplib.FTP):
@@ -32,91 +90,185 @@ class FtpTlsSession(ftplib.FTP_TLS):
         self.prot_p()
 
 
+class _PoolEntry():
+    """A pooled connection, with what the pool tracks about it."""
+    __slots__ = ('ftp_host', 'last_used', 'base_url', 'conn_hash')
+
+    def __init__(self, ftp_host, last_used, base_url, conn_hash):
+        self.ftp_host = ftp_host
+        self.last_used = last_used
+        # e.g. "ftp://user@host:21"
+        self.base_url = base_url
+        self.conn_hash = conn_hash
+
+
 class FtpWrapper():
-    __conn_pool = {}
-    __conn_timestamps = {}
-    __last_noop_check = {}
-    __conn_base_urls = {}  # hash → base_url (e.g., "ftp://user@host:21")
+    # Connections are shared by all threads: a `with` block checks one out
+    # and returns it to the idle connections of its server afterwards.
+    # Nested `with` blocks of a thread share the connection it checked out.
+    __idle = {}  # hash → deque of idle _PoolEntry, least recently used first
+    # All idle _PoolEntry -as keys- of all servers, least recently used first
+    __idle_lru = OrderedDict()
+    __in_use = set()  # checked out _PoolEntry
+    __retired = set()  # checked out _PoolEntry to close once returned
+    __conn_counts = {}  # hash → open connections, including logins under way
+    __pool_size = 0  # Sum of the above
+    __base_url_hashes = {}  # base_url → hashes of its open connections
     __last_visited_paths = {}  # base_url → last_full_url
+    # Guards the containers above; never held during network round trips
     __pool_lock = threading.Lock()
+    # Notified -all waiters, they may wait for different servers- whenever
+    # a connection is returned or closed
+    __pool_changed = threading.Condition(__pool_lock)
+    # The current thread's checked out connections: hash → [entry, depth],
+    # entry is None after a nested block closed it as dropped
+    __checkouts = threading.local()
     # Connection timeout: close connections idle for more than 2 minutes
     __CONNECTION_TIMEOUT = 120
-    # Max pool size: limit to 3 FTPHost objects per server
+    # Max pool size: limit to 3 FTPHost objects
     # (each FTPHost can spawn multiple child connections)
     __MAX_POOL_SIZE = 3
-    # NOOP validation cache: only validate connection if last check was this long ago
-    __NOOP_CHECK_INTERVAL = 5.0  # seconds
+    # Seconds to wait for a connection when the pool is full, before opening
+    # one beyond the limit: the waiting thread may itself hold connections
+    # that others are waiting for
+    __CHECKOUT_TIMEOUT = 5
+    # Idle connections are timed out by a background thread, every 30 seconds
+    __EVICTION_INTERVAL = 30
+    # Set to stop the running eviction thread, None if there is none
+    __evictor_stop = None
+
+    # A wrapper is created for every file system operation
+    __slots__ = (
+        '_url', '_scheme', '_path', '_host', '_port', '_user', '_passwd',
+        '_conn_hash', '_base_url', '_checkout', '_reused')
 
     def __init__(self, url):
-        u = self._get_bookmark(url)
-        self._url = u.geturl()
-        self._scheme = '%s://' % (u.scheme,)
-        self._path = u.path or '/'
-        self._host = u.hostname or ''
-        self._port = u.port or 21
-        self._user = unquote(u.username or '')
-        self._passwd = unquote(u.password or '')
+        (self._url, self._scheme, self._path, self._host, self._port,
+         self._user, self._passwd, self._conn_hash, self._base_url) = \
+            self._get_connection_details(url)
+        self._checkout = None
+        self._reused = False
 
     def __enter__(self):
-        with self.__pool_lock:
-            # Clean up stale connections periodically
-            self._cleanup_stale_connections()
-
-            if self.hash in self.__conn_pool:
-                conn = self.__conn_pool[self.hash]
-                current_time = time.time()
-
-                # Check if connection is still valid and not closed
-                if not conn.closed:
-                    # Only validate with NOOP if we haven't checked recently
-                    last_check = self.__last_noop_check.get(self.hash, 0)
-                    needs_validation = (current_time - last_check) > self.__NOOP_CHECK_INTERVAL
-
-                    if needs_validation:
-                        try:
-                            conn._session.voidcmd('NOOP')
-                            self.__last_noop_check[self.hash] = current_time
-                        except:
-                            # Connection is stale, remove it from pool
-                            self._remove_connection(self.hash)
-                            # Fall through to create new connection
-                        else:
-                            # NOOP succeeded, connection is valid
-                            self.__conn_timestamps[self.hash] = current_time
-                            return self
-                    else:
-                        # Skip NOOP, connection was validated recently
-                        self.__conn_timestamps[self.hash] = current_time
-                        return self
-                else:
-                    # Connection is closed, remove it from pool
-                    self._remove_connection(self.hash)
+        checkouts = self._thread_checkouts()
+        checkout = checkouts.get(self._conn_hash)
+        if checkout is None:
+            checkout = [self._check_out(), 0]
+            checkouts[self._conn_hash] = checkout
+        else:
+            self._reused = True
+        checkout[1] += 1
+        self._checkout = checkout
+        return self
 
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        checkout, self._checkout = self._checkout, None
+        entry = checkout[0]
+        # The server dropped the connection, don't hand it out again
+        dropped = exc_value is not None and is_connection_error(exc_value)
+        checkout[1] -= 1
+        if not checkout[1]:
+            del self._thread_checkouts()[self._conn_hash]
+        elif dropped and entry is not None:
+            # The enclosing blocks continue on a new connection, see `conn`
+            checkout[0] = None
+        else:
+            return
+        if entry is not None:
+            self._check_in(entry, dropped)
+
+    def _check_out(self):
+        """Return an idle connection to this server, or open a new one."""
+        conn_hash = self._conn_hash
+        deadline = None
+        with self.__pool_lock:
+            to_close = []
+            while True:
+                idle = self.__idle.get(conn_hash)
+                if idle:
+                    entry = idle.pop()
+                    del self.__idle_lru[entry]
+                    if entry.ftp_host.closed:
+                        self._discard_count(entry.conn_hash, entry.base_url)
+                        to_close.append(entry)
+                        continue
+                    # Pooled connections are reused without probing them
+                    # first (e.g. NOOP): callers retry once on a fresh
+                    # connection if the server dropped it meanwhile, see
+                    # `is_connection_error`
+                    self.__in_use.add(entry)
+                    self._reused = True
+                    break
+                if self.__pool_size < self.__MAX_POOL_SIZE:
+                    entry = None
+                    break
+                # Make room by closing an idle connection to another server
+                entry = self._pop_least_recently_used()
+                if entry is not None:
+                    to_close.append(entry)
+                    continue
+                if deadline is None:
+                    deadline = time.monotonic() + self.__CHECKOUT_TIMEOUT
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.__pool_changed.wait(remaining)
+            if entry is None:
+                # Reserve the new connection's place in the pool
+                self._add_count(conn_hash, self._base_url)
+                self._ensure_evictor()
+        self._close_entries(to_close)
+        if entry is not None:
+            entry.last_used = time.monotonic()
+            return entry
+
+        self._reused = False
+        try:
             # Create new connection
             session_factory = \
                 FtpTlsSession if self._scheme == 'ftps://' else FtpSession
             ftp_host = ftputil.FTPHost(
                 self._host, self._port, self._user, self._passwd,
                 session_factory=session_factory)
-
-            # Increase stat cache size for large directories
-            # Default is 5000, which causes cache eviction in large dirs
-            ftp_host.stat_cache.resize(20000)
-
-            current_time = time.time()
-            self.__conn_pool[self.hash] = ftp_host
-            self.__conn_timestamps[self.hash] = current_time
-            self.__last_noop_check[self.hash] = current_time
-            # Track base URL for this connection
-            base_url = self._get_base_url()
-            self.__conn_base_urls[self.hash] = base_url
-            return self
-
-    def __exit__(self, exc_type, exc_value, exc_tb):
-        # Clean up stale child connections after each operation
-        if self.hash in self.__conn_pool:
-            self._cleanup_children(self.__conn_pool[self.hash])
-        return
+        except:
+            with self.__pool_lock:
+                self._discard_count(conn_hash, self._base_url)
+                self.__pool_changed.notify_all()
+            raise
+
+        entry = _PoolEntry(
+            ftp_host, time.monotonic(), self._base_url, conn_hash)
+        with self.__pool_lock:
+            self.__in_use.add(entry)
+        return entry
+
+    def _check_in(self, entry, dropped=False):
+        """Return a checked out connection to the pool, or close it."""
+        close = dropped or entry.ftp_host.closed
+        if not close:
+            # Clean up stale child connections after each operation
+            self._cleanup_children(entry.ftp_host)
+        to_close = []
+        with self.__pool_lock:
+            self.__in_use.discard(entry)
+            if dropped:
+                # The server most likely dropped its other idle connections
+                # too: make sure the caller's retry logs in anew
+                to_close = self._pop_idle([entry.conn_hash])
+            if entry in self.__retired:
+                self.__retired.discard(entry)
+                close = True
+            # Connections opened beyond the limit aren't kept
+            if close or self.__pool_size > self.__MAX_POOL_SIZE:
+                close = True
+                self._discard_count(entry.conn_hash, entry.base_url)
+                to_close.append(entry)
+            else:
+                entry.last_used = time.monotonic()
+                self.__idle.setdefault(entry.conn_hash, deque()).append(entry)
+                self.__idle_lru[entry] = None
+            self.__pool_changed.notify_all()
+        self._close_entries(to_close)
 
     def _cleanup_children(self, ftp_host):
         """Close stale child connections that have finished their file transfers."""
@@ -133,46 +285,125 @@ class FtpWrapper():
         for i in reversed(stale_indices):
             del ftp_host._children[i]
 
-    def _get_bookmark(self, url):
-        u = urlparse(url)
-        url_without_path = u._replace(path='').geturl()
-
+    @staticmethod
+    def _get_connection_details(url):
         bookmarks = \
             load_json('FTP Bookmarks.json', default={})
-        # Replace base URL -if found in bookmarks-, keep the same path
-        if url_without_path in bookmarks:
-            u = urlparse(bookmarks[url_without_path][0])._replace(path=u.path)
-
-        return u
-
-    @property
-    def hash(self):
-        return hash((
-            threading.get_ident(), self._host, self._port, self._user,
-            self._passwd))
-
-    def _get_base_url(self):
-        """Return the base URL (without path) for this connection."""
-        if self._user:
-            return '%s%s@%s:%d' % (self._scheme, self._user, self._host, self._port)
-        else:
-            return '%s%s:%d' % (self._scheme, self._host, self._port)
+        # Replace base URL -if found in bookmarks-, keep the same path.
+        # Bookmarks are looked up every time: they can change at any moment
+        bookmark = bookmarks.get(get_url_without_path(url))
+        return _parse_connection_details(
+            url, bookmark[0] if bookmark is not None else None)
 
     @property
     def conn(self):
-        if self.hash not in self.__conn_pool:
+        checkout = self._checkout
+        if checkout is None:
             raise Exception('Not connected')
-        return self.__conn_pool[self.hash]
+        if checkout[0] is None:
+            # A nested block closed the connection the server had dropped
+            checkout[0] = self._check_out()
+        return checkout[0].ftp_host
 
     @property
     def path(self):
         return self._path
 
-    def _remove_connection(self, conn_hash):
-        """Remove a connection from the pool and close it."""
-        if conn_hash in self.__conn_pool:
+    @property
+    def reused(self):
+        """Whether the last `__enter__` reused a pooled connection."""
+        return self._reused
+
+    @classmethod
+    def _thread_checkouts(cls):
+        checkouts = getattr(cls.__checkouts, 'by_hash', None)
+        if checkouts is None:
+            checkouts = cls.__checkouts.by_hash = {}
+        return checkouts
+
+    # The following helpers expect the pool lock to be held
+
+    @classmethod
+    def _add_count(cls, conn_hash, base_url):
+        count = cls.__conn_counts.get(conn_hash, 0)
+        cls.__conn_counts[conn_hash] = count + 1
+        cls.__pool_size += 1
+        if not count:
+            cls.__base_url_hashes.setdefault(base_url, set()).add(conn_hash)
+
+    @classmethod
+    def _discard_count(cls, conn_hash, base_url):
+        count = cls.__conn_counts[conn_hash] - 1
+        cls.__pool_size -= 1
+        if count:
+            cls.__conn_counts[conn_hash] = count
+            return
+        del cls.__conn_counts[conn_hash]
+        hashes = cls.__base_url_hashes.get(base_url)
+        if hashes is not None:
+            hashes.discard(conn_hash)
+            if not hashes:
+                del cls.__base_url_hashes[base_url]
+
+    @classmethod
+    def _pop_idle(cls, conn_hashes):
+        """Remove the idle connections with the given hashes."""
+        entries = []
+        for conn_hash in conn_hashes:
+            for entry in cls.__idle.pop(conn_hash, ()):
+                del cls.__idle_lru[entry]
+                cls._discard_count(entry.conn_hash, entry.base_url)
+                entries.append(entry)
+        cls.__pool_changed.notify_all()
+        return entries
+
+    @classmethod
+    def _pop_stale_connections(cls):
+        """Remove connections that have been idle for too long."""
+        current_time = time.monotonic()
+        stale = []
+        for entry in cls.__idle_lru:
+            if current_time - entry.last_used <= cls.__CONNECTION_TIMEOUT:
+                break
+            stale.append(entry)
+        for _ in stale:
+            cls._pop_least_recently_used()
+        return stale
+
+    @classmethod
+    def _pop_least_recently_used(cls):
+        """Remove the idle connection that was used longest ago, if any."""
+        if not cls.__idle_lru:
+            return None
+        entry, _ = cls.__idle_lru.popitem(last=False)
+        # Connections are returned to both in the same order, so it's also
+        # the least recently used of its server
+        cls.__idle[entry.conn_hash].popleft()
+        cls._discard_count(entry.conn_hash, entry.base_url)
+        return entry
+
+    @classmethod
+    def _ensure_evictor(cls):
+        if cls.__evictor_stop is None:
+            cls.__evictor_stop = threading.Event()
+            threading.Thread(
+                target=cls._evict_stale_connections,
+                args=(cls.__evictor_stop,), daemon=True).start()
+
+    @classmethod
+    def _evict_stale_connections(cls, stop):
+        """Close stale connections until `stop` is set."""
+        while not stop.wait(cls.__EVICTION_INTERVAL):
+            with cls.__pool_lock:
+                stale = cls._pop_stale_connections()
+            cls._close_entries(stale)
+
+    @staticmethod
+    def _close_entries(entries):
+        """Close the given removed connections."""
+        for entry in entries:
             try:
-                ftp_host = self.__conn_pool[conn_hash]
+                ftp_host = entry.ftp_host
                 # Close all child connections first
                 for child in ftp_host._children[:]:
                     try:
@@ -183,80 +414,32 @@ class FtpWrapper():
                 ftp_host.close()
             except:
                 pass
-            del self.__conn_pool[conn_hash]
-            if conn_hash in self.__conn_timestamps:
-                del self.__conn_timestamps[conn_hash]
-            if conn_hash in self.__last_noop_check:
-                del self.__last_noop_check[conn_hash]
-            if conn_hash in self.__conn_base_urls:
-                del self.__conn_base_urls[conn_hash]
-
-    def _cleanup_stale_connections(self):
-        """Remove connections that have been idle for too long."""
-        current_time = time.time()
-        stale_hashes = []
-
-        for conn_hash, timestamp in self.__conn_timestamps.items():
-            if current_time - timestamp > self.__CONNECTION_TIMEOUT:
-                stale_hashes.append(conn_hash)
-
-        for conn_hash in stale_hashes:
-            self._remove_connection(conn_hash)
-
-        # Enforce max pool size (remove oldest connections)
-        if len(self.__conn_pool) > self.__MAX_POOL_SIZE:
-            sorted_conns = sorted(
-                self.__conn_timestamps.items(),
-                key=lambda x: x[1]
-            )
-            excess_count = len(self.__conn_pool) - self.__MAX_POOL_SIZE
-            for conn_hash, _ in sorted_conns[:excess_count]:
-                self._remove_connection(conn_hash)
 
     @classmethod
     def close_all_connections(cls):
         """Close all connections in the pool. Useful for cleanup."""
         with cls.__pool_lock:
-            for conn_hash in list(cls.__conn_pool.keys()):
-                try:
-                    ftp_host = cls.__conn_pool[conn_hash]
-                    # Close all child connections first
-                    for child in ftp_host._children[:]:
-                        try:
-                            child.close()
-                        except:
-                            pass
-                    # Close the main connection
-                    ftp_host.close()
-                except:
-                    pass
-            cls.__conn_pool.clear()
-            cls.__conn_timestamps.clear()
-            cls.__last_noop_check.clear()
-            cls.__conn_base_urls.clear()
+            entries = cls._pop_idle(list(cls.__idle))
+            # Connections in use are closed once returned
+            cls.__retired.update(cls.__in_use)
             cls.__last_visited_paths.clear()
+            if cls.__evictor_stop is not None:
+                cls.__evictor_stop.set()
+                cls.__evictor_stop = None
+        cls._close_entries(entries)
+
+    @classmethod
+    def get_base_url(cls, url):
+        """
+        Return the base URL of the connections to `url`, as listed by
+        `get_open_connections`: bookmarks resolved, with an explicit port.
+        """
+        return cls._get_connection_details(url)[-1]
 
     @classmethod
     def record_visited_path(cls, url):
         """Record the last visited path for a connection's base URL."""
-        u = urlparse(url)
-        url_without_path = u._replace(path='').geturl()
-
-        # Resolve bookmark alias to actual URL (same as _get_bookmark)
-        bookmarks = load_json('FTP Bookmarks.json', default={})
-        if url_without_path in bookmarks:
-            u = urlparse(bookmarks[url_without_path][0])._replace(path=u.path)
-
-        # Build base URL matching _get_base_url format
-        scheme = '%s://' % u.scheme
-        host = u.hostname or ''
-        port = u.port or 21
-        user = unquote(u.username or '')
-
-        if user:
-            base_url = '%s%s@%s:%d' % (scheme, user, host, port)
-        else:
-            base_url = '%s%s:%d' % (scheme, host, port)
+        base_url = cls.get_base_url(url)
 
         with cls.__pool_lock:
             cls.__last_visited_paths[base_url] = url
@@ -266,9 +449,8 @@ class FtpWrapper():
         """Return list of (base_url, last_visited_url) for active connections."""
         with cls.__pool_lock:
             # Get all unique base URLs from active connections
-            active_base_urls = set(cls.__conn_base_urls.values())
             result = []
-            for base_url in active_base_urls:
+            for base_url in cls.__base_url_hashes:
                 last_url = cls.__last_visited_paths.get(base_url, base_url + '/')
                 result.append((base_url, last_url))
             return result
@@ -278,31 +460,13 @@ class FtpWrapper():
         """Close a specific connection by its base URL."""
         with cls.__pool_lock:
             # Find all hashes that match this base_url
-            hashes_to_remove = [
-                h for h, url in cls.__conn_base_urls.items()
-                if url == base_url
-            ]
-            for conn_hash in hashes_to_remove:
-                if conn_hash in cls.__conn_pool:
-                    try:
-                        ftp_host = cls.__conn_pool[conn_hash]
-                        # Close all child connections first
-                        for child in ftp_host._children[:]:
-                            try:
-                                child.close()
-                            except:
-                                pass
-                        # Close the main connection
-                        ftp_host.close()
-                    except:
-                        pass
-                    del cls.__conn_pool[conn_hash]
-                    if conn_hash in cls.__conn_timestamps:
-                        del cls.__conn_timestamps[conn_hash]
-                    if conn_hash in cls.__last_noop_check:
-                        del cls.__last_noop_check[conn_hash]
-                    if conn_hash in cls.__conn_base_urls:
-                        del cls.__conn_base_urls[conn_hash]
+            hashes_to_remove = set(cls.__base_url_hashes.get(base_url, ()))
+            entries = cls._pop_idle(hashes_to_remove)
+            # Connections in use are closed once returned
+            cls.__retired.update(
+                entry for entry in cls.__in_use
+                if entry.conn_hash in hashes_to_remove)
             # Also clear the last visited path for this connection
             if base_url in cls.__last_visited_paths:
                 del cls.__last_visited_paths[base_url]
+        cls._close_entries(entries)